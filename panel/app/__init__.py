@@ -1,19 +1,76 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from datetime import datetime, timedelta
 import os
 
 db = SQLAlchemy()
 login_manager = LoginManager()
+scheduler = None # APScheduler, created by start_scheduler in full mode
+
+def create_app(api_only=None):
+    """
+    Build the panel app.
+
+    api_only (default: PANEL_MODE=api in the environment) builds a lean app for
+    stream workers: only the public api blueprint (/get.php, /api/playlist,
+    /stream/, ...), no admin blueprints (and so no psutil/docker imports), no
+    schema work or admin bootstrap, and no background scheduler. It expects a
+    full-mode instance to own the database schema and the EPG refresh.
+    """
+    if api_only is None:
+        api_only = os.environ.get('PANEL_MODE', 'full') == 'api'
 
-def create_app():
     app = Flask(__name__, static_url_path='/panel/static')
+    app.config['API_ONLY'] = api_only
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-change-this')
     # Use /instance/panel.db for persistence (mounted volume)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////instance/panel.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Profile 1 in N API requests (0 = off); overridable at runtime from the dashboard
+    app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+    app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', '/instance/profiles')
+    # Admission control; per-user values on StreamUser override the defaults (0 = unlimited).
+    # Concurrent streams per user are counted across every worker sharing RELAY_SLOT_DIR
+    # (lock files; empty = count per worker process). Request rates are per worker, and
+    # MAX_RELAYS caps the relays of each worker process, not the whole deployment.
+    app.config['DEFAULT_MAX_CONNECTIONS'] = int(os.environ.get('DEFAULT_MAX_CONNECTIONS', '2'))
+    app.config['DEFAULT_REQUESTS_PER_MINUTE'] = int(os.environ.get('DEFAULT_REQUESTS_PER_MINUTE', '30'))
+    # Failed logins allowed per client IP per minute, before bcrypt is even tried
+    app.config['AUTH_FAILURES_PER_MINUTE'] = int(os.environ.get('AUTH_FAILURES_PER_MINUTE', '10'))
+    app.config['MAX_RELAYS'] = int(os.environ.get('MAX_RELAYS', '1500'))
+    app.config['RELAY_SLOT_DIR'] = os.environ.get('RELAY_SLOT_DIR', '/instance/relays')
+    # XMLTV guide served at /xmltv.php, rebuilt in the background (0 minutes = never)
+    app.config['EPG_DIR'] = os.environ.get('EPG_DIR', '/instance/epg')
+    app.config['EPG_REFRESH_MINUTES'] = int(os.environ.get('EPG_REFRESH_MINUTES', '360'))
+    app.config['EPG_PAST_HOURS'] = int(os.environ.get('EPG_PAST_HOURS', '6'))
+    app.config['EPG_FUTURE_HOURS'] = int(os.environ.get('EPG_FUTURE_HOURS', '48'))
+    # Disk LRU cache behind /logo/<id>
+    app.config['LOGO_CACHE_DIR'] = os.environ.get('LOGO_CACHE_DIR', '/instance/logos')
+    app.config['LOGO_CACHE_MB'] = int(os.environ.get('LOGO_CACHE_MB', '256'))
+    # Dashboard metrics: sample every N seconds, keep the last METRICS_HISTORY samples
+    app.config['METRICS_INTERVAL_SECONDS'] = int(os.environ.get('METRICS_INTERVAL_SECONDS', '5'))
+    app.config['METRICS_HISTORY'] = int(os.environ.get('METRICS_HISTORY', '720'))
+    # Cache snapshot for warm restarts (empty = disabled)
+    app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH', '/instance/cache.snapshot')
 
     db.init_app(app)
+
+    if app.config['RELAY_SLOT_DIR']:
+        from .utils.limits import admission
+        admission.use_shared_slots(app.config['RELAY_SLOT_DIR'])
+
+    from .routes.api import api_bp
+    app.register_blueprint(api_bp, url_prefix='/') # Root prefix for get.php
+
+    # Map the last cache snapshot so the first requests after a restart are cache hits
+    if app.config['SNAPSHOT_PATH']:
+        from .routes.api import load_snapshot
+        load_snapshot(app.config['SNAPSHOT_PATH'])
+
+    if api_only:
+        return app
+
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
 
@@ -37,11 +94,10 @@ def create_app():
     from .routes.playlists import playlists_bp
     app.register_blueprint(playlists_bp, url_prefix='/panel')
 
-    from .routes.api import api_bp
-    app.register_blueprint(api_bp, url_prefix='/') # Root prefix for get.php
-
     with app.app_context():
         db.create_all()
+        from .utils.schema import add_missing_columns
+        add_missing_columns(db)
         # Create default admin if not exists
         if not Admin.query.filter_by(username='admin').first():
             from werkzeug.security import generate_password_hash
@@ -52,6 +108,43 @@ def create_app():
             db.session.add(default_admin)
             db.session.commit()
 
+    start_scheduler(app)
 
-    
     return app
+
+def start_scheduler(app):
+    """Background jobs. APScheduler is imported here so API-only workers never load it."""
+    global scheduler
+    from flask_apscheduler import APScheduler
+
+    if scheduler is None:
+        scheduler = APScheduler()
+    scheduler.init_app(app)
+    if app.config['EPG_REFRESH_MINUTES'] > 0:
+        from .routes.api import refresh_epg
+        from .utils.epg import GUIDE_FILENAME
+        # Build a guide right after boot only if there is none or it is due;
+        # a restart otherwise keeps the one on disk until its next refresh
+        interval = timedelta(minutes=app.config['EPG_REFRESH_MINUTES'])
+        try:
+            built = os.path.getmtime(os.path.join(app.config['EPG_DIR'], GUIDE_FILENAME))
+            next_run = datetime.fromtimestamp(built) + interval
+        except OSError:
+            next_run = datetime.now()
+        scheduler.add_job(
+            id='refresh_epg', func=refresh_epg, args=[app],
+            trigger='interval', minutes=app.config['EPG_REFRESH_MINUTES'],
+            next_run_time=max(next_run, datetime.now()),
+            max_instances=1, coalesce=True, replace_existing=True
+        )
+    if app.config['METRICS_INTERVAL_SECONDS'] > 0:
+        from .utils.metrics import metrics
+        metrics.resize(app.config['METRICS_HISTORY'])
+        scheduler.add_job(
+            id='sample_metrics', func=metrics.sample,
+            trigger='interval', seconds=app.config['METRICS_INTERVAL_SECONDS'],
+            next_run_time=datetime.now(),
+            max_instances=1, coalesce=True, replace_existing=True
+        )
+    if not scheduler.running:
+        scheduler.start()
@@ -15,6 +15,13 @@ class StreamUser(db.Model):
     notes = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=True)
+    # Admission limits; None falls back to the DEFAULT_* app config
+    max_connections = db.Column(db.Integer, nullable=True) # concurrent /stream/ relays
+    max_requests_per_minute = db.Column(db.Integer, nullable=True) # /get.php, /api/playlist, /stream/
+    # Channel bundle: comma-separated group-title patterns (fnmatch, case-insensitive)
+    # and upstream playlist names; empty means everything
+    bundle_categories = db.Column(db.Text, nullable=True)
+    bundle_sources = db.Column(db.Text, nullable=True)
 
     def to_htpasswd_line(self):
         """Returns the line formatted for .htpasswd file"""
@@ -22,6 +29,12 @@ class StreamUser(db.Model):
         # compatible hash (e.g. APR1 or Bcrypt) that Nginx expects.
         return f"{self.username}:{self.password_hash}"
 
+    def bundle(self):
+        """(category patterns, source names) tuples; both empty if the user sees every channel"""
+        def split(value):
+            return tuple(part.strip() for part in (value or '').split(',') if part.strip())
+        return split(self.bundle_categories), split(self.bundle_sources)
+
 class Playlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
@@ -31,6 +44,7 @@ class Playlist(db.Model):
     status = db.Column(db.String(20), default='active')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text, nullable=True)
+    epg_url = db.Column(db.String(500), nullable=True) # XMLTV guide; derived from the URL if empty
 
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1,29 +1,167 @@
-from flask import Blueprint, request, Response, stream_with_context, abort
+from flask import Blueprint, request, Response, stream_with_context, abort, jsonify, current_app, send_file, redirect, url_for
 from ..models import StreamUser, Playlist, ProxyPool
 from .. import db
+from ..utils.blocking import run_blocking
+from ..utils.timing import phase, start_request_timing, finish_request_timing
+from ..utils.limits import admission
+from ..utils import epg
+from ..utils.channel_index import ChannelIndex, container_extension
+from ..utils.snapshot import Snapshot, write_snapshot
+from ..utils.health import source_health
+from ..utils.logo_cache import LogoCache, logo_token, resolve_token, sniff_file
 import requests
 import base64
 import urllib.parse
 from passlib.hash import bcrypt
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import hashlib
+import gzip
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 api_bp = Blueprint('api', __name__)
 logger = logging.getLogger(__name__)
 
+# Per-phase timings (Server-Timing header) and opt-in sampling profiler
+api_bp.before_request(start_request_timing)
+api_bp.after_request(finish_request_timing)
+
 # Simple in-memory cache (replace with Redis for production)
 _playlist_cache = {}
 
+# Last good body and validators (ETag/Last-Modified) per upstream URL, for conditional re-fetches
+_upstream_cache = {}
+
+# On-disk copy of the caches above and the channel index, so a restarted
+# worker serves the last known good playlist instead of stampeding upstreams.
+# Restored entries are served even if expired for SNAPSHOT_GRACE_SECONDS after boot.
+SNAPSHOT_GRACE_SECONDS = 300
+_snapshot = {'path': None, 'view': None, 'timer': None}
+_snapshot_lock = threading.Lock()
+# Cache changes are written out at most this often, off the request path
+SNAPSHOT_DELAY_SECONDS = 30
+_snapshot_timer_lock = threading.Lock()
+
+# Distinct playlist/upstream/index bodies by sha1. Every user's cached playlist
+# is usually the same text; it is held and hashed once, not once per user.
+_bodies = {}
+_bodies_lock = threading.Lock()  # upstream fetches run on a thread pool; the snapshot timer prunes
+
+# Recent successful bcrypt verifications: (username, password_hash) -> (sha256 of password, expiry).
+# IPTV apps call player_api.php many times per session; without this each call
+# pays a full bcrypt verify. Keyed on the stored hash so a password change invalidates it.
+AUTH_CACHE_SECONDS = 300
+_auth_cache = {}
+
+# Shared channel index behind player_api.php, bundles and relay failover (one for all users)
+CHANNEL_INDEX_MAX_AGE = 3600
+_channel_index = {'index': None, 'timestamp': 0.0, 'stale_ok_until': 0.0, 'blob': None}
+_channel_index_lock = threading.Lock()
+
+# Created on first /logo/ request from LOGO_CACHE_DIR / LOGO_CACHE_MB
+_logo_cache = None
+LOGO_MAX_AGE = 30 * 24 * 3600
+LOGO_MISS_MAX_AGE = 3600
+# Logos are provider content served from our origin: never let them run as a document
+LOGO_HEADERS = {
+    'Content-Security-Policy': "default-src 'none'; sandbox",
+    'X-Content-Type-Options': 'nosniff',
+}
+
+# Upstreams fetched in parallel per playlist build. Under the gevent worker
+# these threads are greenlets, so this bounds open upstream sockets, not OS threads.
+MAX_PARALLEL_FETCHES = 8
+
+# Relay chunk size: large enough to keep per-chunk overhead low, small enough
+# not to add noticeable latency to live streams
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Relay failover: a read that waits RELAY_STALL_SECONDS counts as a stalled source.
+# A relay may switch sources RELAY_MAX_FAILOVERS times in a row; the count
+# resets once a source has played for RELAY_STABLE_SECONDS.
+RELAY_CONNECT_TIMEOUT = 5
+RELAY_STALL_SECONDS = 8
+RELAY_MAX_FAILOVERS = 4
+RELAY_STABLE_SECONDS = 60
+
 def check_auth(username, password):
+    """Returns the StreamUser for valid credentials, else None"""
     user = StreamUser.query.filter_by(username=username).first()
     if user:
+        cache_key = (user.username, user.password_hash)
+        digest = hashlib.sha256(password.encode()).digest()
+        cached = _auth_cache.get(cache_key)
+        if cached and cached[0] == digest and cached[1] > time.monotonic():
+            return user
+
         # Check password hash (htpasswd bcrypt format)
         try:
-            return bcrypt.verify(password, user.password_hash)
+            if run_blocking(bcrypt.verify, password, user.password_hash):
+                _auth_cache[cache_key] = (digest, time.monotonic() + AUTH_CACHE_SECONDS)
+                return user
         except Exception:
-            return False
-    return False
+            return None
+    return None
+
+def user_limit(user, attr, default_key):
+    """Per-user admission limit, falling back to the app-wide default"""
+    value = getattr(user, attr)
+    return value if value is not None else current_app.config[default_key]
+
+def error_response(status, message, as_json=False, retry_after=None):
+    if as_json:
+        resp = jsonify({'error': message})
+        resp.status_code = status
+    else:
+        resp = Response(message, status=status, mimetype='text/plain')
+    if retry_after:
+        resp.headers['Retry-After'] = str(retry_after)
+    return resp
+
+def client_address():
+    """Client IP as seen by nginx (the panel is only reachable through it)"""
+    return request.headers.get('X-Real-IP') or request.remote_addr
+
+def authenticate_request(as_json=False, username=None, password=None):
+    """
+    Authenticate, then rate-limit, the given credentials (default: the
+    username/password query args).
+
+    Failed logins are limited per client address and that limit is checked
+    before bcrypt, so a client guessing passwords is turned away without
+    burning CPU on hashing. The user's own request bucket is only charged
+    once the password checks out, so nobody can exhaust it (and lock the
+    real user out) just by knowing the username.
+
+    Returns:
+        (StreamUser, None) on success, (None, error Response) otherwise
+    """
+    username = username or request.args.get('username')
+    password = password or request.args.get('password')
+    auth_failed = 'Authentication failed' if as_json else 'Auth Failed'
+    client = client_address()
+    failures_per_minute = current_app.config['AUTH_FAILURES_PER_MINUTE']
+
+    retry_after = admission.check_failures(client, failures_per_minute)
+    if retry_after:
+        logger.warning(f"⚠ RATE LIMIT: failed logins from {client} (retry in {retry_after}s)")
+        return None, error_response(429, 'Too many failed logins', as_json, retry_after)
+
+    user = check_auth(username, password) if username and password else None
+    if not user:
+        admission.record_failure(client, failures_per_minute)
+        return None, error_response(401, auth_failed, as_json)
+
+    per_minute = user_limit(user, 'max_requests_per_minute', 'DEFAULT_REQUESTS_PER_MINUTE')
+    retry_after = admission.check_rate(user.username, per_minute)
+    if retry_after:
+        logger.warning(f"⚠ RATE LIMIT: {username} (retry in {retry_after}s)")
+        return None, error_response(429, 'Rate limit exceeded', as_json, retry_after)
+    return user, None
 
 def get_cache_key(username):
     """Generate cache key for playlist"""
@@ -34,20 +172,72 @@ def get_cached_playlist(username, max_age_seconds=3600):
     cache_key = get_cache_key(username)
     if cache_key in _playlist_cache:
         cached_data = _playlist_cache[cache_key]
-        age = (datetime.utcnow() - cached_data['timestamp']).total_seconds()
-        if age < max_age_seconds:
+        now = datetime.utcnow()
+        age = (now - cached_data['timestamp']).total_seconds()
+        if age < max_age_seconds or now < cached_data.get('stale_ok_until', now):
+            content = cached_content(cached_data)
+            if content is None:
+                _playlist_cache.pop(cache_key, None)
+                return None
             logger.info(f"✓ Cache hit for {username} (age: {age:.0f}s)")
-            return cached_data['content']
+            return content
     return None
 
 def cache_playlist(username, content):
     """Cache playlist content"""
     cache_key = get_cache_key(username)
+    content, blob = intern_body(content)
     _playlist_cache[cache_key] = {
         'content': content,
+        'blob': blob,
         'timestamp': datetime.utcnow()
     }
     logger.info(f"✓ Cached playlist for {username}")
+    prune_bodies()
+    schedule_snapshot()
+
+def intern_body(text):
+    """
+    (shared text, sha1 name) for `text`, reusing an identical body already
+    held. Comparing against the few distinct bodies is far cheaper than
+    hashing a multi-megabyte playlist again.
+    """
+    with _bodies_lock:
+        held = list(_bodies.items())
+    for name, body in held:
+        if body is text or (len(body) == len(text) and body == text):
+            return body, name
+    name = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    with _bodies_lock:
+        return _bodies.setdefault(name, text), name
+
+def cached_content(entry):
+    """
+    Content of a cache entry, decoding it from the snapshot mapping on first
+    use. None if the snapshot blob is unreadable; callers treat that as a miss.
+    """
+    if 'content' not in entry:
+        name = entry['blob']
+        with _bodies_lock:
+            body = _bodies.get(name)
+        if body is None:
+            body = _snapshot['view'].blob(name)
+            if body is None:
+                return None
+            with _bodies_lock:
+                body = _bodies.setdefault(name, body)
+        entry['content'] = body
+    return entry['content']
+
+def prune_bodies():
+    """Forget bodies no cache entry or index snapshot refers to any more"""
+    referenced = {entry['blob'] for entry in list(_playlist_cache.values())}
+    referenced.update(entry['blob'] for entry in list(_upstream_cache.values()))
+    referenced.add(_channel_index['blob'])
+    with _bodies_lock:
+        for name in list(_bodies):
+            if name not in referenced:
+                del _bodies[name]
 
 def fetch_from_upstream(upstream_url, headers=None, timeout=8):
     """
@@ -97,15 +287,41 @@ def fetch_from_upstream(upstream_url, headers=None, timeout=8):
     
     proxies = {}
     proxy_msg = ""
+
+    # Revalidate instead of re-downloading when we hold a previous copy
+    previous = _upstream_cache.get(upstream_url)
+    if previous and cached_content(previous) is None:
+        _upstream_cache.pop(upstream_url, None)
+        previous = None
+    if previous:
+        headers = dict(headers)
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
     
     # Strategy 1: Try direct first (fastest)
     try:
         logger.info(f"  → Direct fetch with {len(headers)} headers...")
         resp = requests.get(upstream_url, headers=headers, proxies={}, timeout=timeout)
         
-        if 200 <= resp.status_code < 300:
+        if resp.status_code == 304 and previous:
+            logger.info("  ✓ Returned 304 - upstream unchanged")
+            previous['fetched_at'] = time.time()
+            return cached_content(previous)
+        elif 200 <= resp.status_code < 300:
             logger.info(f"  ✓ Returned {resp.status_code} - GOT DATA!")
-            return resp.text
+            content, blob = intern_body(resp.text)
+            _upstream_cache[upstream_url] = {
+                'content': content,
+                'blob': blob,
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'fetched_at': time.time(),
+            }
+            if previous and previous['blob'] != blob:
+                prune_bodies()
+            return content
         else:
             logger.warning(f"  ⚠ Returned {resp.status_code}")
     except requests.Timeout:
@@ -116,6 +332,35 @@ def fetch_from_upstream(upstream_url, headers=None, timeout=8):
     # Direct-only; proxies/VPN disabled
     return None
 
+def fetch_all_upstreams(playlists):
+    """
+    Fetch every upstream concurrently, so one slow provider costs its own
+    timeout instead of adding to everyone else's.
+
+    Args:
+        playlists: Playlist rows to fetch
+
+    Returns:
+        {"playlist name": "m3u_content", ...} for upstreams that returned data,
+        in the same order as `playlists`
+    """
+    # Read plain values here; ORM rows stay on the request's session
+    sources = [(playlist.name, playlist.url) for playlist in playlists]
+    if not sources:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_FETCHES, len(sources))) as pool:
+        results = list(pool.map(lambda source: fetch_from_upstream(source[1]), sources))
+
+    upstream_contents = {}
+    for (name, _), content in zip(sources, results):
+        if content:
+            upstream_contents[name] = content
+            logger.info(f"  ✓ {name}: got {content.count('#EXTINF')} channels")
+        else:
+            logger.error(f"  ✗ {name}: fetch failed")
+    return upstream_contents
+
 def combine_playlists(playlist_dict):
     """
     Combine multiple M3U playlists into one.
@@ -167,23 +412,39 @@ def get_playlist():
     5. Returns combined M3U to TV app
     """
     username = request.args.get('username')
-    password = request.args.get('password')
 
-    # Step 1: Authenticate
-    if not username or not password or not check_auth(username, password):
-        return Response("Auth Failed", status=401)
+    # Step 1: Rate limit + authenticate
+    with phase('auth'):
+        user, error = authenticate_request()
+    if error:
+        return error
 
     logger.info(f"✓ AUTH: {username} authenticated")
 
+    # Users with a channel bundle get a filtered view of the shared index,
+    # streamed straight from its entries
+    bundle = user.bundle()
+    if any(bundle):
+        index = get_channel_index()
+        if index is None:
+            logger.warning("⚠ No content retrieved (upstreams offline?)")
+            return Response("#EXTM3U\n", mimetype='audio/x-mpegurl')
+        with phase('view'):
+            view = index.view(*bundle)
+        logger.info(f"✓ RETURN: {len(view)} of {len(index.channels)} channels (bundle)\n")
+        return Response(view.iter_m3u(), mimetype='audio/x-mpegurl')
+
     # Step 2: Check cache
-    cached = get_cached_playlist(username, max_age_seconds=3600)
+    with phase('cache'):
+        cached = get_cached_playlist(username, max_age_seconds=3600)
     if cached:
         channels = cached.count('#EXTINF')
         logger.info(f"✓ CACHE HIT: {channels} channels from cache")
         return Response(cached, mimetype='audio/x-mpegurl')
 
     # Step 3: Get all active upstreams
-    playlists = Playlist.query.filter_by(status='active').all()
+    with phase('db'):
+        playlists = Playlist.query.filter_by(status='active').all()
 
     if not playlists:
         logger.warning(f"⚠ No active upstreams configured")
@@ -191,21 +452,9 @@ def get_playlist():
 
     logger.info(f"→ FETCH: {len(playlists)} upstream(s) to fetch")
 
-    # Step 4: Fetch from each upstream (direct only)
-    upstream_contents = {}
-
-    for playlist in playlists:
-        logger.info(f"\n→ {playlist.name}")
-
-        # Direct fetch only (VPN/proxy disabled)
-        content = fetch_from_upstream(playlist.url)
-
-        if content:
-            upstream_contents[playlist.name] = content
-            channels = content.count('#EXTINF')
-            logger.info(f"  ✓ Got {channels} channels")
-        else:
-            logger.error(f"  ✗ Fetch failed")
+    # Step 4: Fetch all upstreams in parallel (direct only, VPN/proxy disabled)
+    with phase('fetch'):
+        upstream_contents = fetch_all_upstreams(playlists)
 
     # Step 5: Combine all playlists
     if not upstream_contents:
@@ -213,7 +462,9 @@ def get_playlist():
         return Response("#EXTM3U\n", mimetype='audio/x-mpegurl')
 
     logger.info(f"\n→ COMBINE: {len(upstream_contents)} source(s)")
-    combined_m3u = combine_playlists(upstream_contents)
+    with phase('combine'):
+        combined_m3u = run_blocking(combine_playlists, upstream_contents)
+    refresh_channel_index(upstream_contents)
 
     # Step 6: Cache the combined result
     cache_playlist(username, combined_m3u)
@@ -225,20 +476,177 @@ def get_playlist():
     return Response(combined_m3u, mimetype='audio/x-mpegurl')
 
 
+def open_upstream(url):
+    """Connect to a stream source, recording the outcome in source_health. Returns the response or None."""
+    try:
+        resp = requests.get(url, stream=True, timeout=(RELAY_CONNECT_TIMEOUT, RELAY_STALL_SECONDS))
+    except requests.RequestException as e:
+        logger.warning(f"  ⚠ Stream connect failed ({source_health.host(url)}): {str(e)[:60]}")
+        source_health.record(url, ok=False)
+        return None
+    if resp.status_code >= 400:
+        logger.warning(f"  ⚠ Stream source returned {resp.status_code} ({source_health.host(url)})")
+        resp.close()
+        source_health.record(url, ok=False)
+        return None
+    source_health.record(url, ok=True)
+    return resp
+
+
+def connect_first(urls):
+    """(url, response) for the first of `urls` that connects, else (None, None)"""
+    for url in urls:
+        resp = open_upstream(url)
+        if resp is not None:
+            return url, resp
+    return None, None
+
+
+def relay_with_failover(url, resp, sources):
+    """
+    Yield the stream body. When the source errors, stalls or ends, reconnect
+    to the healthiest other source of the same channel (the failed one is
+    tried last) and keep relaying, so the viewer sees a hiccup rather than a
+    dead stream.
+    """
+    failovers = 0
+    while True:
+        started = time.monotonic()
+        try:
+            for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+            reason = 'source ended'
+        except requests.RequestException as e:
+            reason = str(e)[:60]
+        finally:
+            resp.close()
+
+        source_health.record(url, ok=False)
+        if time.monotonic() - started > RELAY_STABLE_SECONDS:
+            failovers = 0
+        failovers += 1
+        if failovers > RELAY_MAX_FAILOVERS:
+            logger.warning(f"✗ RELAY: {reason}; gave up after {RELAY_MAX_FAILOVERS} failovers")
+            return
+
+        candidates = source_health.rank([src for src in sources if src != url]) + [url]
+        new_url, new_resp = connect_first(candidates)
+        if new_resp is None:
+            logger.warning(f"✗ RELAY: {reason}; no source reachable")
+            return
+        logger.info(f"↻ RELAY: {reason}; switched {source_health.host(url)} → {source_health.host(new_url)}")
+        url, resp = new_url, new_resp
+
+
+def current_channel_index():
+    """
+    The channel index if built, restorable from the snapshot, or buildable
+    from upstream playlists already in memory; never fetches upstreams.
+    """
+    if _channel_index['index'] is None:
+        with _channel_index_lock:
+            if _channel_index['index'] is None:
+                restore_channel_index()
+            if _channel_index['index'] is None:
+                upstream_contents = cached_upstream_contents()
+                if upstream_contents:
+                    install_channel_index(upstream_contents)
+    return _channel_index['index']
+
+
+def cached_upstream_contents():
+    """{playlist name: content} of active upstreams held in _upstream_cache, in playlist order"""
+    contents = {}
+    for playlist in Playlist.query.filter_by(status='active').all():
+        entry = _upstream_cache.get(playlist.url)
+        content = cached_content(entry) if entry else None
+        if content is not None:
+            contents[playlist.name] = content
+    return contents
+
+
 @api_bp.route('/stream/<encoded_url>')
 def proxy_stream(encoded_url):
+    """
+    Relay an upstream stream. Requires username/password query args so
+    relays count against the user's concurrent stream cap.
+    """
+    with phase('auth'):
+        user, error = authenticate_request()
+    if error:
+        return error
+
     try:
-        # Decode URL
         original_url = base64.urlsafe_b64decode(encoded_url).decode()
+    except Exception as e:
+        logger.error(f"Stream error: {e}")
+        return abort(400)
+    return relay_stream(user, original_url)
+
+
+def relay_stream(user, original_url):
+    """
+    Admission-controlled relay of `original_url` for `user`. Live channels
+    known to the channel index fail over between their sources; anything
+    else (VOD, HLS playlists, unknown URLs) is relayed once as-is.
+    """
+    username = user.username
+
+    # Admission: reject fast rather than queue when the user or the pool is full
+    slot, rejected = admission.acquire_stream(
+        username,
+        user_limit(user, 'max_connections', 'DEFAULT_MAX_CONNECTIONS'),
+        current_app.config['MAX_RELAYS']
+    )
+    if rejected:
+        status, retry_after = rejected
+        if status == 429:
+            logger.warning(f"⚠ STREAM LIMIT: {username} at max concurrent streams")
+            return error_response(429, 'Too many concurrent streams', retry_after=retry_after)
+        logger.warning(f"⚠ RELAY POOL FULL: {admission.active_streams()} active relays")
+        return error_response(503, 'Relay capacity reached', retry_after=retry_after)
+
+    # Anything raised before the response owns the slot must hand it back
+    req = None
+    try:
+        index = current_channel_index()
+        sources = index.sources_for(original_url) if index else []
+        if container_extension(original_url) == 'm3u8':
+            sources = []
 
         # Stream Content (direct access, no proxy)
-        req = requests.get(original_url, stream=True, timeout=10)
+        # 'connect' covers time to upstream response headers; the body is relayed after
+        with phase('connect'):
+            if sources:
+                # Start on the requested source, then the healthiest alternates
+                candidates = [original_url] + source_health.rank([src for src in sources if src != original_url])
+                url, req = connect_first(candidates)
+            else:
+                url, req = original_url, open_upstream(original_url)
+        if req is None:
+            logger.error(f"Stream error: no reachable source for {source_health.host(original_url)}")
+            abort(500)
 
-        return Response(stream_with_context(req.iter_content(chunk_size=1024)),
-                        content_type=req.headers.get('content-type'))
-    except Exception as e:
-        logger.error(f"Stream error: {e}")
-        return abort(500)
+        if sources and 'mpegurl' not in req.headers.get('content-type', '').lower():
+            body = relay_with_failover(url, req, sources)
+        else:
+            body = req.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+
+        response = Response(stream_with_context(body), content_type=req.headers.get('content-type'))
+    except BaseException:
+        if req is not None:
+            req.close()
+        admission.release_stream(username, slot)
+        raise
+
+    # Runs when the client disconnects or the upstream ends
+    @response.call_on_close
+    def release():
+        req.close()
+        admission.release_stream(username, slot)
+
+    return response
 
 
 def parse_m3u_playlist(content):
@@ -322,47 +730,521 @@ def api_playlist():
         - category: optional filter by category
     """
     username = request.args.get('username')
-    password = request.args.get('password')
     category_filter = request.args.get('category')
     
-    # Authenticate
-    if not username or not password or not check_auth(username, password):
-        return {'error': 'Authentication failed'}, 401
+    # Rate limit + authenticate
+    with phase('auth'):
+        user, error = authenticate_request(as_json=True)
+    if error:
+        return error
     
-    # Get or fetch playlist
-    cached = get_cached_playlist(username, max_age_seconds=3600)
-    if not cached:
-        playlists = Playlist.query.filter_by(status='active').all()
-        upstream_contents = {}
-        
-        for playlist in playlists:
-            content = fetch_from_upstream(playlist.url)
-            if content:
-                upstream_contents[playlist.name] = content
-        
-        if not upstream_contents:
+    bundle = user.bundle()
+    if any(bundle):
+        # Same shape as parse_m3u_playlist, built from the user's view of the shared index
+        index = get_channel_index()
+        if index is None:
             return {'error': 'No content available', 'channels': [], 'categories': {}}, 503
-        
-        cached = combine_playlists(upstream_contents)
-        cache_playlist(username, cached)
-    
-    # Parse and return
-    parsed = parse_m3u_playlist(cached)
+        with phase('view'):
+            parsed = {'categories': {}, 'channels': []}
+            for entry in index.view(*bundle):
+                channel = dict(entry)  # logos are rewritten below; entries are shared
+                parsed['channels'].append(channel)
+                parsed['categories'].setdefault(channel['category'], []).append(channel)
+            parsed['total'] = len(parsed['channels'])
+    else:
+        # Get or fetch playlist
+        with phase('cache'):
+            cached = get_cached_playlist(username, max_age_seconds=3600)
+        if not cached:
+            with phase('db'):
+                playlists = Playlist.query.filter_by(status='active').all()
+            with phase('fetch'):
+                upstream_contents = fetch_all_upstreams(playlists)
+
+            if not upstream_contents:
+                return {'error': 'No content available', 'channels': [], 'categories': {}}, 503
+
+            with phase('combine'):
+                cached = run_blocking(combine_playlists, upstream_contents)
+            refresh_channel_index(upstream_contents)
+            cache_playlist(username, cached)
+
+        # Parse and return
+        with phase('parse'):
+            parsed = run_blocking(parse_m3u_playlist, cached)
+
+    # Point logos at our /logo/ cache instead of the provider CDNs
+    with phase('logos'):
+        secret = current_app.config['SECRET_KEY']
+        logo_base = url_for('api.logo', logo_id='')
+        for channel in parsed['channels']:
+            if channel['tvg_logo'].startswith(('http://', 'https://')):
+                channel['tvg_logo'] = logo_base + logo_token(channel['tvg_logo'], secret)
     
     # Filter by category if requested
     if category_filter:
         cat_channels = parsed['categories'].get(category_filter, [])
-        return {
+        body = {
             'category': category_filter,
             'channels': cat_channels,
             'total': len(cat_channels),
             'all_categories': list(parsed['categories'].keys())
         }
-    
+    else:
+        body = {
+            'total': parsed['total'],
+            'categories': parsed['categories'],
+            'all_categories': list(parsed['categories'].keys())
+        }
+
+    # Serialize here rather than on return so it shows up as its own phase
+    with phase('serialize'):
+        return jsonify(body)
+
+
+def refresh_epg(app):
+    """
+    Background job: rebuild the merged XMLTV guide.
+
+    Fetches the active upstream playlists to learn which tvg-ids are in the
+    combined playlist, then fetches each upstream's guide, prunes it to those
+    channels and the configured time window, and caches the gzipped result.
+    """
+    with app.app_context():
+        epg_dir = app.config['EPG_DIR']
+        with epg.RefreshLock(os.path.join(epg_dir, '.refresh.lock')) as acquired:
+            if not acquired:
+                logger.info("EPG refresh already running in another worker, skipping")
+                return
+
+            playlists = Playlist.query.filter_by(status='active').all()
+            upstream_contents = fetch_all_upstreams(playlists)
+            if not upstream_contents:
+                logger.warning("⚠ EPG: no playlist content, keeping previous guide")
+                return
+
+            tvg_ids = epg.extract_tvg_ids(combine_playlists(upstream_contents))
+            sources = []
+            for playlist in playlists:
+                url = epg.guide_url_for(playlist.url, playlist.epg_url,
+                                        upstream_contents.get(playlist.name))
+                if url:
+                    sources.append((playlist.name, url))
+
+            if not tvg_ids or not sources:
+                logger.warning(f"⚠ EPG: {len(tvg_ids)} tvg-ids, {len(sources)} guide source(s); nothing to build")
+                return
+
+            epg.build_guide(sources, tvg_ids, epg_dir,
+                            past_hours=app.config['EPG_PAST_HOURS'],
+                            future_hours=app.config['EPG_FUTURE_HOURS'])
+
+
+@api_bp.route('/xmltv.php')
+def xmltv():
+    """
+    Serve the cached, merged XMLTV guide. The guide is built by the
+    background refresh_epg job, so this is only a file send: gzip as-is to
+    clients that accept it, decompressed on the fly otherwise.
+    """
+    with phase('auth'):
+        user, error = authenticate_request()
+    if error:
+        return error
+
+    path = os.path.join(current_app.config['EPG_DIR'], epg.GUIDE_FILENAME)
+    if not os.path.exists(path):
+        return error_response(503, 'Guide not ready', retry_after=60)
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = send_file(path, mimetype='application/xml', conditional=True, max_age=300)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    def generate():
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    return Response(generate(), mimetype='application/xml', headers={'Vary': 'Accept-Encoding'})
+
+
+def get_channel_index(max_age_seconds=CHANNEL_INDEX_MAX_AGE):
+    """
+    Shared ChannelIndex over the combined playlist, rebuilt when older than
+    max_age_seconds. Only one request rebuilds at a time; if every upstream
+    fails the previous index keeps being served.
+    """
+    entry = _channel_index
+
+    def fresh():
+        now = time.monotonic()
+        return entry['index'] is not None and (
+            now - entry['timestamp'] < max_age_seconds or now < entry['stale_ok_until'])
+
+    if fresh():
+        return entry['index']
+
+    with _channel_index_lock:
+        # Another request may have rebuilt it (or restored it from the snapshot) while we waited
+        if entry['index'] is None:
+            restore_channel_index()
+        if fresh():
+            return entry['index']
+
+        with phase('db'):
+            playlists = Playlist.query.filter_by(status='active').all()
+        with phase('fetch'):
+            upstream_contents = fetch_all_upstreams(playlists)
+        if not upstream_contents:
+            logger.warning("⚠ INDEX: no upstream content, keeping previous index")
+            return entry['index']
+
+        return install_channel_index(upstream_contents)
+
+
+def install_channel_index(upstream_contents):
+    """Build the index from fetched upstream content and make it current (caller holds _channel_index_lock)"""
+    with phase('index'):
+        index = run_blocking(lambda: ChannelIndex(index_channels(upstream_contents)))
+    _channel_index.update({
+        'index': index,
+        'timestamp': time.monotonic(),
+        'stale_ok_until': 0.0,
+        'blob': None,  # serialized for the snapshot when it is next written
+    })
+    prune_bodies()
+    logger.info(f"✓ INDEX: {len(index.channels)} entries, {len(index.bodies)} precomputed bodies")
+    schedule_snapshot()
+    return index
+
+
+def refresh_channel_index(upstream_contents):
+    """
+    Called where upstreams were just fetched for a playlist: rebuild the
+    index from that content if it is missing or older than
+    CHANNEL_INDEX_MAX_AGE, so relay failover has the channel -> alternates
+    map even when nothing else (player_api.php, bundles) builds the index.
+    """
+    def stale():
+        entry = _channel_index
+        return entry['index'] is None or time.monotonic() - entry['timestamp'] >= CHANNEL_INDEX_MAX_AGE
+
+    # Skip if another request is already rebuilding it
+    if not stale() or not _channel_index_lock.acquire(blocking=False):
+        return
+    try:
+        if stale():
+            install_channel_index(upstream_contents)
+    finally:
+        _channel_index_lock.release()
+
+
+def index_channels(upstream_contents):
+    """
+    Parsed channels of every upstream in order, tagged with their source
+    (playlist name) for bundle rules. Duplicate URLs are dropped as in
+    combine_playlists, so the index matches the combined playlist.
+    """
+    channels = []
+    seen_urls = set()
+    for source_name, content in upstream_contents.items():
+        for channel in parse_m3u_playlist(content)['channels']:
+            if channel['url'] in seen_urls:
+                continue
+            seen_urls.add(channel['url'])
+            channel['source'] = source_name
+            channels.append(channel)
+    return channels
+
+
+def restore_channel_index():
+    """Rebuild the channel index from the snapshot's parsed channel list, if there is one"""
+    view = _snapshot['view']
+    meta = view.header.get('index') if view else None
+    if not meta:
+        return
+    try:
+        channels = json.loads(view.blob(meta['blob']) or 'null')
+    except ValueError as e:
+        channels = None
+        logger.warning(f"⚠ INDEX: ignoring snapshot copy: {e}")
+    if not isinstance(channels, list):
+        return
+    age = max(0.0, time.time() - meta['built_at'])
+    _channel_index.update({
+        'index': ChannelIndex(channels),
+        'timestamp': time.monotonic() - age,
+        'stale_ok_until': time.monotonic() + SNAPSHOT_GRACE_SECONDS,
+        'blob': meta['blob'],
+    })
+    logger.info(f"✓ INDEX: restored {len(channels)} entries from snapshot (age: {age:.0f}s)")
+
+
+def load_snapshot(path):
+    """
+    Called from create_app: map the snapshot and restore cache metadata.
+    Only the small header is parsed here; playlist bodies and the channel
+    index are decoded from the mapping the first time they are needed.
+    """
+    _snapshot['path'] = path
+    view = Snapshot.open(path)
+    if view is None:
+        return
+    _snapshot['view'] = view
+
+    stale_ok_until = datetime.utcnow() + timedelta(seconds=SNAPSHOT_GRACE_SECONDS)
+    for cache_key, meta in view.header.get('playlists', {}).items():
+        _playlist_cache.setdefault(cache_key, {
+            'blob': meta['blob'],
+            'timestamp': datetime.utcfromtimestamp(meta['timestamp']),
+            'stale_ok_until': stale_ok_until,
+        })
+    for url, meta in view.header.get('upstreams', {}).items():
+        _upstream_cache.setdefault(url, dict(meta))
+    logger.info(f"✓ SNAPSHOT: mapped {path} ({len(_playlist_cache)} playlists, {len(_upstream_cache)} upstreams)")
+
+
+def schedule_snapshot():
+    """
+    Write the snapshot SNAPSHOT_DELAY_SECONDS from now, coalescing every
+    cache change made in the meantime into one write.
+    """
+    if not _snapshot['path']:
+        return
+    with _snapshot_timer_lock:
+        if _snapshot['timer'] is not None:
+            return
+        # A timer rather than a scheduler job: API-only workers run no scheduler
+        timer = threading.Timer(SNAPSHOT_DELAY_SECONDS, run_scheduled_snapshot)
+        timer.daemon = True
+        _snapshot['timer'] = timer
+    timer.start()
+
+
+def run_scheduled_snapshot():
+    with _snapshot_timer_lock:
+        _snapshot['timer'] = None
+    save_snapshot()
+
+
+def save_snapshot():
+    """
+    Write the playlist/upstream caches and the channel index to the snapshot file.
+
+    Bodies are referenced by the sha1 name computed when they were cached, so
+    nothing is re-hashed here. Bodies still only in the previous snapshot's
+    mapping are copied across as bytes, never decoded.
+    """
+    path = _snapshot['path']
+    if not path:
+        return
+
+    with _snapshot_lock:
+        view = _snapshot['view']
+        blobs = {}
+
+        def add_blob(name, content=None):
+            if name not in blobs:
+                if content is None:
+                    with _bodies_lock:
+                        content = _bodies.get(name)
+                body = content
+                blobs[name] = body if body is not None else view.raw(name)
+            return name
+
+        index = _channel_index['index']
+        if index is not None and _channel_index['blob'] is None:
+            _, _channel_index['blob'] = intern_body(json.dumps(index.channels, separators=(',', ':')))
+
+        header = {'version': 1, 'created': time.time(), 'playlists': {}, 'upstreams': {}}
+        for cache_key, entry in list(_playlist_cache.items()):
+            header['playlists'][cache_key] = {
+                'blob': add_blob(entry['blob'], entry.get('content')),
+                'timestamp': entry['timestamp'].replace(tzinfo=timezone.utc).timestamp(),
+            }
+        for url, entry in list(_upstream_cache.items()):
+            header['upstreams'][url] = {
+                'blob': add_blob(entry['blob'], entry.get('content')),
+                'etag': entry.get('etag'),
+                'last_modified': entry.get('last_modified'),
+                'fetched_at': entry.get('fetched_at'),
+            }
+        if index is not None:
+            header['index'] = {
+                'blob': add_blob(_channel_index['blob']),
+                'built_at': time.time() - (time.monotonic() - _channel_index['timestamp']),
+            }
+
+        prune_bodies()
+
+        try:
+            write_snapshot(path, header, blobs)
+        except OSError as e:
+            logger.warning(f"⚠ SNAPSHOT: could not write {path}: {e}")
+
+
+def xtream_auth_info(user):
+    """user_info/server_info block returned by player_api.php without an action"""
+    now = datetime.utcnow()
+    host = request.host.split(':')[0]
+    port = request.host.split(':')[1] if ':' in request.host else ('443' if request.scheme == 'https' else '80')
     return {
-        'total': parsed['total'],
-        'categories': parsed['categories'],
-        'all_categories': list(parsed['categories'].keys())
+        'user_info': {
+            'username': user.username,
+            'password': request.args.get('password'),
+            'message': '',
+            'auth': 1,
+            'status': 'Active' if user.status == 'active' else 'Disabled',
+            'exp_date': str(int(user.expires_at.timestamp())) if user.expires_at else None,
+            'is_trial': '0',
+            'active_cons': str(admission.active_streams(user.username)),
+            'created_at': str(int(user.created_at.timestamp())) if user.created_at else None,
+            'max_connections': str(user_limit(user, 'max_connections', 'DEFAULT_MAX_CONNECTIONS')),
+            'allowed_output_formats': ['ts', 'm3u8'],
+        },
+        'server_info': {
+            'url': host,
+            'port': port,
+            'https_port': '443',
+            'server_protocol': request.scheme,
+            'rtmp_port': '0',
+            'timezone': 'UTC',
+            'timestamp_now': int(now.timestamp()),
+            'time_now': now.strftime('%Y-%m-%d %H:%M:%S'),
+        },
     }
 
 
+@api_bp.route('/player_api.php')
+def player_api():
+    """
+    Xtream Codes API subset for IPTV apps:
+    get_live_categories, get_live_streams, get_vod_categories, get_vod_streams,
+    get_series_categories, get_series and get_series_info (optional category_id).
+    Bodies come precomputed from the shared ChannelIndex, or from the user's
+    bundle view of it.
+    """
+    with phase('auth'):
+        user, error = authenticate_request(as_json=True)
+    if error:
+        if error.status_code == 401:
+            # Xtream clients look for auth == 0 rather than the status code
+            return jsonify({'user_info': {'auth': 0}}), 401
+        return error
+
+    action = request.args.get('action')
+    if not action:
+        return jsonify(xtream_auth_info(user))
+
+    index = get_channel_index()
+    if index is None:
+        return error_response(503, 'No content available', as_json=True, retry_after=60)
+    view = index.view(*user.bundle())
+    if view is not None:
+        index = view  # same body()/get() interface, restricted to the user's bundle
+
+    if action == 'get_series_info':
+        # Entries in an M3U are single episodes, so each "series" has one episode
+        try:
+            entry = index.get(int(request.args.get('series_id', '')), kind='series')
+        except ValueError:
+            entry = None
+        if entry is None:
+            return jsonify({'info': {}, 'episodes': {}})
+        return jsonify({
+            'info': {'name': entry['name'], 'cover': entry['tvg_logo'],
+                     'category_id': str(entry['category_id'])},
+            'episodes': {'1': [{
+                'id': str(entry['stream_id']),
+                'episode_num': 1,
+                'title': entry['name'],
+                'container_extension': container_extension(entry['url'], 'mp4'),
+                'season': 1,
+            }]},
+        })
+
+    with phase('lookup'):
+        body = index.body(action, request.args.get('category_id'))
+    if body is None:
+        return error_response(400, f'Unsupported action: {action}', as_json=True)
+    return Response(body, mimetype='application/json')
+
+
+@api_bp.route('/live/<username>/<password>/<stream_file>')
+@api_bp.route('/movie/<username>/<password>/<stream_file>')
+@api_bp.route('/series/<username>/<password>/<stream_file>')
+def xtream_play(username, password, stream_file):
+    """
+    Resolve an Xtream playback URL (/<kind>/<user>/<pass>/<stream_id>.<ext>).
+    Live channels are relayed (admission control + failover); VOD and series
+    redirect to the upstream so seeking is handled there.
+    """
+    with phase('auth'):
+        user, error = authenticate_request(username=username, password=password)
+    if error:
+        return error
+
+    kind = request.path.split('/')[1]
+    try:
+        stream_id = int(stream_file.split('.')[0])
+    except ValueError:
+        abort(404)
+
+    index = get_channel_index()
+    view = index.view(*user.bundle()) if index is not None else None
+    if view is not None:
+        index = view
+    entry = index.get(stream_id, kind=kind) if index is not None else None
+    if entry is None:
+        abort(404)
+    if kind == 'live':
+        return relay_stream(user, entry['url'])
+    return redirect(entry['url'], code=302)
+
+
+def get_logo_cache():
+    global _logo_cache
+    if _logo_cache is None:
+        _logo_cache = LogoCache(current_app.config['LOGO_CACHE_DIR'],
+                                current_app.config['LOGO_CACHE_MB'] * 1024 * 1024,
+                                negative_ttl=LOGO_MISS_MAX_AGE)
+    return _logo_cache
+
+
+@api_bp.route('/logo/<logo_id>')
+def logo(logo_id):
+    """
+    Channel logo from the disk cache, fetched from the provider on first use.
+    Ids are signed (see logo_token), so this cannot be used to fetch arbitrary URLs.
+    """
+    url = resolve_token(logo_id, current_app.config['SECRET_KEY'])
+    if url is None:
+        response = Response('Not found', status=404, mimetype='text/plain')
+        response.headers.update(LOGO_HEADERS)
+        return response
+
+    cache = get_logo_cache()
+    with phase('cache'):
+        path, miss = cache.get(url)
+    if path is None and miss is None:
+        with phase('fetch'):
+            path = cache.fetch(url)
+
+    # Files cached before only raster images were accepted may be anything
+    mimetype = sniff_file(path) if path else None
+    if mimetype is None:
+        response = Response('Logo unavailable', status=404, mimetype='text/plain')
+        response.headers['Cache-Control'] = f'public, max-age={LOGO_MISS_MAX_AGE}'
+        response.headers.update(LOGO_HEADERS)
+        return response
+
+    # The id is derived from the URL, so the content behind an id never changes
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=LOGO_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={LOGO_MAX_AGE}, immutable'
+    response.headers.update(LOGO_HEADERS)
+    return response
@@ -1,29 +1,115 @@
-from flask import Blueprint, render_template, current_app
+from flask import Blueprint, render_template, current_app, request, redirect, url_for, flash, Response
 from flask_login import login_required, current_user
-import psutil
+from ..models import Settings
+from ..utils.timing import get_sample_rate, reset_sample_rate_cache
+from ..utils.metrics import metrics
+from ..utils.blocking import under_gevent
+from .. import db
+import json
 import platform
-from datetime import datetime
+import time
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+# Comment line sent on an idle metrics stream so proxies don't time it out
+SSE_KEEPALIVE_SECONDS = 15
+
+# A metrics stream is closed after this long and the browser reconnects (resuming
+# from Last-Event-ID), so a forgotten dashboard tab does not hold a connection forever.
+# Without gevent each stream occupies a whole worker, so it ends after one batch
+# of whatever is buffered, without waiting, and EventSource polls at the retry interval.
+SSE_STREAM_SECONDS = 300
+
+def format_uptime(seconds):
+    days, rest = divmod(int(seconds), 86400)
+    hours, rest = divmod(rest, 3600)
+    return f"{days}d {hours}h {rest // 60}m"
+
 @dashboard_bp.route('/')
 @login_required
 def index():
-    # Gather System Stats
-    cpu_percent = psutil.cpu_percent(interval=None)
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    
+    # Latest background sample; the page itself never samples the host
+    sample = metrics.latest() or {}
+
     system_info = {
         'os': platform.system(),
         'node': platform.node(),
         'release': platform.release(),
-        'uptime': datetime.now().strftime("%Y-%m-%d %H:%M:%S") # Placeholder, explicit uptime needs boot time calc
+        'machine': platform.machine(),
+        'python_version': platform.python_version(),
+        'uptime': format_uptime(time.time() - metrics.boot_time),
+        'boot_time': metrics.boot_time,
     }
 
     return render_template('dashboard.html', 
-                         cpu_usage=cpu_percent,
-                         memory_usage=memory.percent,
-                         disk_usage=disk.percent,
+                         cpu_usage=sample.get('cpu', 0),
+                         memory_usage=sample.get('memory', 0),
+                         disk_usage=sample.get('disk', 0),
                          system_info=system_info,
+                         profile_sample_rate=get_sample_rate(),
                          user=current_user)
+
+@dashboard_bp.route('/metrics/stream')
+@login_required
+def metrics_stream():
+    """
+    Server-Sent Events feed of metric samples. A new connection gets the
+    buffered history, then each new sample as it is taken; reconnects resume
+    from Last-Event-ID. Upstream health is only included when it changed.
+    The stream ends after SSE_STREAM_SECONDS (one batch without gevent).
+    """
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID', '0'))
+    except ValueError:
+        last_seq = 0
+
+    streaming = under_gevent()
+    deadline = time.monotonic() + (SSE_STREAM_SECONDS if streaming else 0)
+
+    def generate():
+        seq = last_seq
+        last_upstreams = None
+        yield 'retry: 5000\n\n'
+        while True:
+            samples = metrics.wait_since(seq, timeout=SSE_KEEPALIVE_SECONDS if streaming else 0)
+            if not samples:
+                yield ': keepalive\n\n'
+            for sample in samples:
+                event = dict(sample)
+                if event['upstreams'] == last_upstreams:
+                    del event['upstreams']
+                else:
+                    last_upstreams = event['upstreams']
+                seq = sample['seq']
+                yield f"id: {seq}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+            if time.monotonic() >= deadline:
+                return
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # let nginx pass events through unbuffered
+    })
+
+@dashboard_bp.route('/profiling', methods=['POST'])
+@login_required
+def set_profiling():
+    """Set the API sampling profiler rate (1 in N requests, 0 = off) without a redeploy"""
+    try:
+        rate = max(0, int(request.form.get('sample_rate', '0')))
+    except ValueError:
+        flash('Sample rate must be a whole number.', 'error')
+        return redirect(url_for('dashboard.index'))
+
+    setting = Settings.query.filter_by(key='profile_sample_rate').first()
+    if not setting:
+        setting = Settings(key='profile_sample_rate')
+        db.session.add(setting)
+    setting.value = str(rate)
+    db.session.commit()
+    reset_sample_rate_cache()
+
+    if rate:
+        flash(f"Profiling 1 in {rate} API requests. Collapsed stacks go to {current_app.config['PROFILE_DIR']}.", 'success')
+    else:
+        flash('API profiling disabled.', 'success')
+    return redirect(url_for('dashboard.index'))
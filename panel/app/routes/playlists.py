@@ -19,6 +19,7 @@ def add_playlist():
     username = request.form.get('username')
     password = request.form.get('password')
     notes = request.form.get('notes')
+    epg_url = request.form.get('epg_url')
     
     if not name or not url:
         flash('Name and URL are required', 'error')
@@ -29,7 +30,8 @@ def add_playlist():
         url=url, 
         username=username, 
         password=password,
-        notes=notes
+        notes=notes,
+        epg_url=epg_url or None
     )
     db.session.add(new_playlist)
     db.session.commit()
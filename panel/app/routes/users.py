@@ -1,6 +1,6 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_required
-from ..models import StreamUser, db
+from ..models import StreamUser, Playlist, db
 from datetime import datetime, timedelta
 import subprocess
 import os
@@ -46,11 +46,26 @@ def sync_htpasswd():
     except Exception as e:
         flash(f"Error syncing .htpasswd: {str(e)}", "error")
 
+def parse_limit(value):
+    """Form value -> int limit; blank or invalid means None (use the default)"""
+    try:
+        return max(0, int(value)) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+def parse_bundle(value):
+    """Comma-separated form value -> normalized list string; blank means None (everything)"""
+    parts = [part.strip() for part in (value or '').split(',') if part.strip()]
+    return ', '.join(parts) or None
+
 @users_bp.route('/users')
 @login_required
 def list_users():
     users = StreamUser.query.all()
-    return render_template('users.html', users=users)
+    sources = [playlist.name for playlist in Playlist.query.filter_by(status='active').all()]
+    return render_template('users.html', users=users, sources=sources,
+                           default_max_connections=current_app.config['DEFAULT_MAX_CONNECTIONS'],
+                           default_requests_per_minute=current_app.config['DEFAULT_REQUESTS_PER_MINUTE'])
 
 @users_bp.route('/users/add', methods=['POST'])
 @login_required
@@ -86,7 +101,11 @@ def add_user():
             username=username, 
             password_hash=password_hash, 
             notes=notes,
-            expires_at=expires_at
+            expires_at=expires_at,
+            max_connections=parse_limit(request.form.get('max_connections')),
+            max_requests_per_minute=parse_limit(request.form.get('max_requests_per_minute')),
+            bundle_categories=parse_bundle(request.form.get('bundle_categories')),
+            bundle_sources=parse_bundle(request.form.get('bundle_sources'))
         )
         db.session.add(new_user)
         db.session.commit()
@@ -150,6 +169,14 @@ def edit_user(id):
     # Update notes
     user.notes = notes
 
+    # Update admission limits (blank = default)
+    user.max_connections = parse_limit(request.form.get('max_connections'))
+    user.max_requests_per_minute = parse_limit(request.form.get('max_requests_per_minute'))
+
+    # Update channel bundle (blank = all channels)
+    user.bundle_categories = parse_bundle(request.form.get('bundle_categories'))
+    user.bundle_sources = parse_bundle(request.form.get('bundle_sources'))
+
     # Update expiry
     if expiry_str:
         try:
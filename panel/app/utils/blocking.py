@@ -0,0 +1,23 @@
+def under_gevent():
+    """True when serving under the gevent worker (stdlib monkey-patched)"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) off the event loop when serving under gevent.
+
+    CPU-bound work (bcrypt, building or parsing a large playlist) never yields,
+    so run inline in a greenlet it stalls every relay and request the worker
+    holds. Under gevent it goes to the hub's native thread pool and the calling
+    greenlet waits for the result; otherwise it simply runs in place.
+    The function must not use the Flask request or app context.
+    """
+    if not under_gevent():
+        return func(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(func, args, kwargs)
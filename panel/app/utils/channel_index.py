@@ -0,0 +1,291 @@
+import bisect
+import fnmatch
+import json
+import os
+import re
+import threading
+import urllib.parse
+import zlib
+from array import array
+
+# Xtream stream types, keyed by the kind we classify each entry as
+KINDS = ('live', 'movie', 'series')
+
+# player_api.php (categories action, streams action) per kind
+ACTIONS = {
+    'live': ('get_live_categories', 'get_live_streams'),
+    'movie': ('get_vod_categories', 'get_vod_streams'),
+    'series': ('get_series_categories', 'get_series'),
+}
+_ACTION_KINDS = {action: kind for kind, actions in ACTIONS.items() for action in actions}
+
+
+def classify(url):
+    """Xtream-style upstream URLs carry the stream type in the path"""
+    path = urllib.parse.urlparse(url).path
+    if '/movie/' in path:
+        return 'movie'
+    if '/series/' in path:
+        return 'series'
+    return 'live'
+
+
+def container_extension(url, default='ts'):
+    ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lstrip('.')
+    return ext or default
+
+
+def stable_id(key, taken):
+    """
+    Positive 31-bit ID derived from `key`, so the same URL keeps the same ID
+    across rebuilds and restarts. Collisions probe to the next free value.
+    """
+    value = (zlib.crc32(key.encode('utf-8')) & 0x7fffffff) or 1
+    while value in taken:
+        value = (value % 0x7fffffff) + 1
+    return value
+
+
+def channel_key(channel):
+    """
+    Identity of a channel across providers: its tvg-id, or failing that its
+    name with bracketed tags, punctuation and case removed (None if neither).
+    """
+    if channel.get('tvg_id'):
+        return 'id:' + channel['tvg_id'].lower()
+    name = re.sub(r'[\[(].*?[\])]', '', channel.get('name', '').lower())
+    name = re.sub(r'[^a-z0-9]+', '', name)
+    return 'name:' + name if name else None
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class ChannelIndex:
+    """
+    Immutable lookup structure over the combined playlist.
+
+    Gives each entry a stable numeric stream ID and precomputes the Xtream
+    player_api.php response bodies (category lists, and stream lists per
+    category and in total) so serving an app request is a dict lookup.
+    Also groups live entries carrying the same channel from different
+    sources, for relay failover, and compiles per-user bundles into
+    ChannelViews over the same entries.
+    """
+
+    def __init__(self, channels):
+        """
+        Args:
+            channels: channel dicts as returned by parse_m3u_playlist, in playlist
+                order, optionally with a 'source' key (upstream playlist name)
+        """
+        self.channels = []
+        self.by_id = {}
+        self.categories = {kind: {} for kind in KINDS}  # kind -> {category name: category_id}
+        self.bodies = {}  # (action, category_id or None) -> JSON bytes
+        self.alternates = {}  # channel key -> [url, ...] of live sources, playlist order
+        self._key_by_url = {}
+        self._position = {}  # stream_id -> index into self.channels
+        self._groups = {}  # (source, category) -> array of positions, ascending
+        self._views = {}  # bundle rules -> ChannelView
+        self._views_lock = threading.Lock()
+
+        taken_category_ids = set()
+        for channel in channels:
+            kind = classify(channel['url'])
+            stream_id = stable_id(channel['url'], self.by_id)
+            kind_categories = self.categories[kind]
+            if channel['category'] not in kind_categories:
+                category_id = stable_id(f"{kind}:{channel['category']}", taken_category_ids)
+                taken_category_ids.add(category_id)
+                kind_categories[channel['category']] = category_id
+
+            entry = dict(channel, stream_id=stream_id, kind=kind,
+                         category_id=kind_categories[channel['category']])
+            self._position[stream_id] = len(self.channels)
+            group = (channel.get('source', ''), channel['category'])
+            self._groups.setdefault(group, array('I')).append(len(self.channels))
+            self.channels.append(entry)
+            self.by_id[stream_id] = entry
+
+            key = channel_key(channel) if kind == 'live' else None
+            if key:
+                self.alternates.setdefault(key, []).append(channel['url'])
+                self._key_by_url[channel['url']] = key
+
+        self._precompute()
+
+    def _stream_record(self, num, entry):
+        if entry['kind'] == 'series':
+            return {
+                'num': num,
+                'name': entry['name'],
+                'series_id': entry['stream_id'],
+                'cover': entry['tvg_logo'],
+                'plot': '',
+                'cast': '',
+                'director': '',
+                'genre': '',
+                'releaseDate': '',
+                'last_modified': '0',
+                'rating': '',
+                'rating_5based': 0,
+                'category_id': str(entry['category_id']),
+            }
+        record = {
+            'num': num,
+            'name': entry['name'],
+            'stream_type': entry['kind'],
+            'stream_id': entry['stream_id'],
+            'stream_icon': entry['tvg_logo'],
+            'added': '0',
+            'category_id': str(entry['category_id']),
+            'custom_sid': '',
+            'direct_source': '',
+        }
+        if entry['kind'] == 'live':
+            record.update({'epg_channel_id': entry['tvg_id'] or None,
+                           'tv_archive': 0, 'tv_archive_duration': 0})
+        else:
+            record.update({'rating': '', 'rating_5based': 0,
+                           'container_extension': container_extension(entry['url'], 'mp4')})
+        return record
+
+    def _precompute(self):
+        for kind, (categories_action, streams_action) in ACTIONS.items():
+            self.bodies[(categories_action, None)] = _dumps([
+                {'category_id': str(category_id), 'category_name': name, 'parent_id': 0}
+                for name, category_id in self.categories[kind].items()
+            ])
+
+            per_category = {}
+            all_records = []
+            for entry in self.channels:
+                if entry['kind'] != kind:
+                    continue
+                record = self._stream_record(len(all_records) + 1, entry)
+                all_records.append(record)
+                per_category.setdefault(entry['category_id'], []).append(record)
+
+            self.bodies[(streams_action, None)] = _dumps(all_records)
+            for category_id, records in per_category.items():
+                self.bodies[(streams_action, str(category_id))] = _dumps(records)
+
+    def body(self, action, category_id=None):
+        """Precomputed JSON bytes for an action, b'[]' for an unknown category, None for an unknown action"""
+        if (action, None) not in self.bodies:
+            return None
+        if category_id:
+            return self.bodies.get((action, str(category_id)), b'[]')
+        return self.bodies[(action, None)]
+
+    def sources_for(self, url):
+        """All live sources (including `url`) of the channel `url` carries; empty if it is not a known live entry"""
+        key = self._key_by_url.get(url)
+        return list(self.alternates[key]) if key else []
+
+    def get(self, stream_id, kind=None):
+        entry = self.by_id.get(stream_id)
+        if entry is None or (kind and entry['kind'] != kind):
+            return None
+        return entry
+
+    def view(self, categories=(), sources=()):
+        """
+        ChannelView of the entries whose category matches one of the
+        `categories` patterns and whose source is one of `sources` (an empty
+        rule matches everything). Returns None if both rules are empty, i.e.
+        the caller should use the whole index.
+
+        Rules are matched against the (source, category) groups rather than
+        individual entries, and each distinct rule is compiled once per index.
+        """
+        key = (tuple(categories), tuple(sources))
+        if not any(key):
+            return None
+        view = self._views.get(key)
+        if view is not None:
+            return view
+
+        patterns = [pattern.lower() for pattern in categories]
+        wanted_sources = {source.lower() for source in sources}
+        matched = [
+            positions for (source, category), positions in self._groups.items()
+            if (not wanted_sources or source.lower() in wanted_sources)
+            and (not patterns or any(fnmatch.fnmatchcase(category.lower(), p) for p in patterns))
+        ]
+        positions = array('I', sorted(position for group in matched for position in group))
+        with self._views_lock:
+            return self._views.setdefault(key, ChannelView(self, positions))
+
+
+class ChannelView:
+    """
+    A user's channel bundle: sorted positions into a shared ChannelIndex.
+
+    Entries are never copied; iteration and the M3U/JSON bodies read the
+    index's entries through the position array. player_api.php bodies are
+    serialized on first request and kept for the lifetime of the index.
+    """
+
+    def __init__(self, index, positions):
+        self.index = index
+        self.positions = positions
+        self._bodies = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        channels = self.index.channels
+        return (channels[position] for position in self.positions)
+
+    def contains(self, stream_id):
+        position = self.index._position.get(stream_id)
+        if position is None:
+            return False
+        i = bisect.bisect_left(self.positions, position)
+        return i < len(self.positions) and self.positions[i] == position
+
+    def get(self, stream_id, kind=None):
+        return self.index.get(stream_id, kind) if self.contains(stream_id) else None
+
+    def iter_m3u(self, batch=1000):
+        """The bundle as M3U text, in chunks of `batch` entries"""
+        yield '#EXTM3U\n'
+        lines = []
+        for entry in self:
+            lines.append(f"{entry['raw']}\n{entry['url']}\n")
+            if len(lines) >= batch:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    def body(self, action, category_id=None):
+        """Same contract as ChannelIndex.body, restricted to this view"""
+        kind = _ACTION_KINDS.get(action)
+        if kind is None:
+            return None
+        key = (action, str(category_id) if category_id else None)
+        body = self._bodies.get(key)
+        if body is not None:
+            return body
+
+        entries = [entry for entry in self if entry['kind'] == kind]
+        if action == ACTIONS[kind][0]:
+            present = {entry['category_id'] for entry in entries}
+            body = _dumps([
+                {'category_id': str(cat_id), 'category_name': name, 'parent_id': 0}
+                for name, cat_id in self.index.categories[kind].items() if cat_id in present
+            ])
+        else:
+            if key[1]:
+                entries = [entry for entry in entries if str(entry['category_id']) == key[1]]
+                if not entries:
+                    return b'[]'  # not cached, so arbitrary category_ids can't grow the cache
+            body = _dumps([self.index._stream_record(num, entry)
+                           for num, entry in enumerate(entries, 1)])
+        self._bodies[key] = body
+        return body
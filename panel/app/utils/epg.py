@@ -0,0 +1,241 @@
+import fcntl
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+GUIDE_FILENAME = 'guide.xml.gz'
+
+# Yield to other greenlets/threads every N parsed elements; a large guide is
+# otherwise one long CPU burst that would stall relays under the gevent worker
+YIELD_EVERY = 2000
+
+
+def guide_url_for(playlist_url, epg_url=None, m3u_content=None):
+    """
+    Work out where an upstream publishes its XMLTV guide, in order of preference:
+    the explicit epg_url, the url-tvg/x-tvg-url attribute of the playlist's
+    #EXTM3U header, or the Xtream xmltv.php next to a get.php playlist URL.
+    """
+    if epg_url:
+        return epg_url
+
+    if m3u_content:
+        header = m3u_content[:m3u_content.find('\n')] if '\n' in m3u_content else m3u_content
+        for attr in ('url-tvg="', 'x-tvg-url="'):
+            if header.startswith('#EXTM3U') and attr in header:
+                start = header.find(attr) + len(attr)
+                end = header.find('"', start)
+                if end > start:
+                    # Some providers list several comma-separated guides; use the first
+                    return header[start:end].split(',')[0].strip()
+
+    parsed = urllib.parse.urlparse(playlist_url)
+    if parsed.path.endswith('/get.php'):
+        query = urllib.parse.parse_qs(parsed.query)
+        if 'username' in query and 'password' in query:
+            creds = urllib.parse.urlencode({
+                'username': query['username'][0],
+                'password': query['password'][0],
+            })
+            path = parsed.path[:-len('get.php')] + 'xmltv.php'
+            return urllib.parse.urlunparse(parsed._replace(path=path, query=creds))
+    return None
+
+
+def extract_tvg_ids(m3u_content):
+    """All non-empty tvg-id values in an M3U playlist"""
+    tvg_ids = set()
+    for line in m3u_content.splitlines():
+        if line.startswith('#EXTINF:') and 'tvg-id="' in line:
+            start = line.find('tvg-id="') + 8
+            end = line.find('"', start)
+            if end > start:
+                tvg_ids.add(line[start:end])
+    return tvg_ids
+
+
+def parse_xmltv_time(value):
+    """'20240101120000 +0100' -> aware datetime (UTC if no offset), None if invalid"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+    offset = value[14:].strip()
+    tz = timezone.utc
+    if len(offset) == 5 and offset[0] in '+-' and offset[1:].isdigit():
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        tz = timezone(delta if offset[0] == '+' else -delta)
+    return parsed.replace(tzinfo=tz)
+
+
+def open_guide_stream(url, timeout=30):
+    """Open an upstream guide as a streaming, decompressed binary file object"""
+    resp = requests.get(url, stream=True, timeout=timeout,
+                        headers={'User-Agent': 'NexusLB/1.0', 'Accept-Encoding': 'gzip, deflate'})
+    resp.raise_for_status()
+    # Undo Content-Encoding on the fly
+    resp.raw.decode_content = True
+    content_type = resp.headers.get('content-type', '')
+    if url.split('?')[0].endswith('.gz') or 'gzip' in content_type:
+        return resp, gzip.GzipFile(fileobj=resp.raw)
+    return resp, resp.raw
+
+
+def _write_element(out, elem):
+    elem.tail = None
+    out.write(ET.tostring(elem, encoding='unicode'))
+    out.write('\n')
+
+
+def prune_guide(stream, tvg_ids, window_start, window_end, channels_out, programmes_out, seen_channels):
+    """
+    Incrementally parse one XMLTV document, keeping only channels whose id is in
+    `tvg_ids` (and not already taken from an earlier source) and programmes for
+    those channels that overlap [window_start, window_end].
+
+    Elements are cleared as soon as they are handled, so memory stays bounded
+    by one element regardless of guide size.
+
+    Returns:
+        (channels kept, programmes kept)
+    """
+    kept_channels = set()
+    programme_count = 0
+    root = None
+    handled = 0
+
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+
+        if elem.tag == 'channel':
+            channel_id = elem.get('id')
+            if channel_id in tvg_ids and channel_id not in seen_channels:
+                _write_element(channels_out, elem)
+                kept_channels.add(channel_id)
+                seen_channels.add(channel_id)
+        elif elem.tag == 'programme':
+            if elem.get('channel') in kept_channels:
+                start = parse_xmltv_time(elem.get('start'))
+                stop = parse_xmltv_time(elem.get('stop')) or start
+                if start and start <= window_end and stop >= window_start:
+                    _write_element(programmes_out, elem)
+                    programme_count += 1
+        else:
+            # Children of channel/programme are serialized with their parent
+            continue
+
+        # Drop the handled element and its reference from the root
+        elem.clear()
+        if root is not None:
+            root.clear()
+
+        handled += 1
+        if handled % YIELD_EVERY == 0:
+            time.sleep(0)
+
+    return len(kept_channels), programme_count
+
+
+def build_guide(sources, tvg_ids, out_dir, past_hours=6, future_hours=48):
+    """
+    Fetch, prune and merge upstream guides into out_dir/guide.xml.gz.
+
+    Channels are written before programmes as XMLTV expects; programmes are
+    spooled to a temporary file while sources are parsed so neither list is
+    held in memory. The finished file replaces the old one atomically.
+
+    Args:
+        sources: [(name, guide_url), ...] in priority order
+        tvg_ids: channel ids present in the combined playlist
+        out_dir: directory holding the cached guide
+
+    Returns:
+        Path of the merged guide, or None if no source could be read
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    now = datetime.now(timezone.utc)
+    window_start = now - timedelta(hours=past_hours)
+    window_end = now + timedelta(hours=future_hours)
+
+    seen_channels = set()
+    sources_read = 0
+    total_programmes = 0
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=out_dir) as channels_out, \
+            tempfile.TemporaryFile('w+', encoding='utf-8', dir=out_dir) as programmes_out:
+        for name, url in sources:
+            logger.info(f"→ EPG: {name}")
+            try:
+                resp, stream = open_guide_stream(url)
+                with resp:
+                    channels, programmes = prune_guide(
+                        stream, tvg_ids, window_start, window_end,
+                        channels_out, programmes_out, seen_channels
+                    )
+                sources_read += 1
+                total_programmes += programmes
+                logger.info(f"  ✓ {channels} channels, {programmes} programmes kept")
+            except Exception as e:
+                logger.warning(f"  ⚠ EPG error for {name}: {str(e)[:80]}")
+
+        if not sources_read:
+            return None
+
+        final_path = os.path.join(out_dir, GUIDE_FILENAME)
+        tmp_path = final_path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            out.write('<tv generator-info-name="NexusLB">\n')
+            for spool in (channels_out, programmes_out):
+                spool.seek(0)
+                shutil.copyfileobj(spool, out)
+            out.write('</tv>\n')
+        os.replace(tmp_path, final_path)
+
+    logger.info(f"✓ EPG: {len(seen_channels)} channels, {total_programmes} programmes "
+                f"from {sources_read}/{len(sources)} source(s)")
+    return final_path
+
+
+class RefreshLock:
+    """
+    Non-blocking inter-process lock so only one gunicorn worker rebuilds the
+    guide at a time; the others skip the run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._fd = open(self.path, 'w')
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._fd.close()
+            self._fd = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+        return False
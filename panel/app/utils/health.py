@@ -0,0 +1,50 @@
+import threading
+import time
+import urllib.parse
+
+
+class SourceHealth:
+    """
+    Recent health of upstream hosts, as an exponentially weighted success
+    rate in [0, 1]. Each connect, stall or drop is one observation; hosts
+    never seen score 1.0 so new sources get tried.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._hosts = {}  # host -> {'score', 'ok', 'failed', 'last_ok', 'last_failure'}
+
+    @staticmethod
+    def host(url):
+        return urllib.parse.urlparse(url).netloc
+
+    def record(self, url, ok):
+        host = self.host(url)
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                'score': 1.0, 'ok': 0, 'failed': 0, 'last_ok': None, 'last_failure': None,
+            })
+            stats['score'] = (1 - self.alpha) * stats['score'] + self.alpha * (1.0 if ok else 0.0)
+            if ok:
+                stats['ok'] += 1
+                stats['last_ok'] = time.time()
+            else:
+                stats['failed'] += 1
+                stats['last_failure'] = time.time()
+
+    def score(self, url):
+        stats = self._hosts.get(self.host(url))
+        return stats['score'] if stats else 1.0
+
+    def rank(self, urls):
+        """Best first; ties keep playlist order"""
+        return sorted(urls, key=lambda url: -self.score(url))
+
+    def snapshot(self):
+        """{host: stats} copy, for display"""
+        with self._lock:
+            return {host: dict(stats) for host, stats in self._hosts.items()}
+
+
+source_health = SourceHealth()
@@ -0,0 +1,194 @@
+import fcntl
+import glob
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+# Slot search bound for users with no stream cap (0 = unlimited)
+UNLIMITED_SLOTS = 4096
+
+
+class TokenBucket:
+    """Classic token bucket: `capacity` burst, refilled at `rate` tokens per second"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Take one token. Returns 0 on success, else seconds until one is available."""
+        wait = self.peek()
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def peek(self):
+        """Like take(), without taking: 0 if a token is available, else seconds until one is"""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class StreamSlots:
+    """
+    Per-user concurrent stream slots shared by every worker process.
+
+    Slot i of a user is the file <directory>/<user hash>.<i>, and a relay
+    holds an exclusive flock on it for its lifetime. The kernel drops the
+    lock when the file is closed or the process dies, so a crashed worker
+    never leaks slots.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _prefix(self, username):
+        return os.path.join(self.directory, hashlib.sha1(username.encode('utf-8')).hexdigest()[:16])
+
+    def acquire(self, username, max_streams):
+        """Lock a free slot. Returns its file descriptor, or None if all `max_streams` are taken."""
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = self._prefix(username)
+        for i in range(max_streams if max_streams and max_streams > 0 else UNLIMITED_SLOTS):
+            fd = os.open(f"{prefix}.{i}", os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        os.close(fd)  # closing drops the lock
+
+    def count(self, username):
+        """Slots currently held by any worker"""
+        held = 0
+        for path in glob.glob(self._prefix(username) + '.*'):
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                held += 1
+            finally:
+                os.close(fd)
+        return held
+
+
+class AdmissionController:
+    """
+    Per-user request rate limits, per-client failed-login limits, per-user
+    concurrent relay caps and a global relay cap. Decisions are made up front
+    and rejected requests are answered immediately (429/503 + Retry-After)
+    instead of queueing behind busy relays.
+
+    Per-user stream caps are shared by all workers once use_shared_slots()
+    has been called (see StreamSlots). Rate limits and the relay cap are
+    per worker process: the relay cap protects the worker's own capacity.
+    """
+
+    def __init__(self):
+        self.slots = None  # StreamSlots, or None to count streams in this process only
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._failure_buckets = {}  # client address -> TokenBucket of failed logins
+        self._streams = Counter()
+        self._relays = 0
+
+    @staticmethod
+    def _bucket(buckets, key, per_minute):
+        bucket = buckets.get(key)
+        if bucket is None or bucket.capacity != per_minute:
+            # Burst up to one minute's allowance, refill continuously
+            bucket = buckets[key] = TokenBucket(per_minute / 60.0, per_minute)
+        return bucket
+
+    def check_rate(self, username, per_minute):
+        """Returns None if the request may proceed, else Retry-After seconds"""
+        if not per_minute or per_minute <= 0:
+            return None
+        with self._lock:
+            wait = self._bucket(self._buckets, username, per_minute).take()
+        return math.ceil(wait) if wait else None
+
+    def check_failures(self, client, per_minute):
+        """
+        Returns Retry-After seconds if `client` has used up its allowance of
+        failed logins, else None. Does not charge the allowance; see record_failure.
+        """
+        if not per_minute or per_minute <= 0:
+            return None
+        with self._lock:
+            bucket = self._failure_buckets.get(client)
+            wait = bucket.peek() if bucket else 0
+        return math.ceil(wait) if wait else None
+
+    def record_failure(self, client, per_minute):
+        if not per_minute or per_minute <= 0:
+            return
+        with self._lock:
+            if len(self._failure_buckets) > 10000:
+                # Forget clients whose allowance has fully refilled
+                for key, bucket in list(self._failure_buckets.items()):
+                    bucket._refill()
+                    if bucket.tokens >= bucket.capacity:
+                        del self._failure_buckets[key]
+            self._bucket(self._failure_buckets, client, per_minute).take()
+
+    def use_shared_slots(self, directory):
+        self.slots = StreamSlots(directory)
+
+    def acquire_stream(self, username, max_streams, max_relays):
+        """
+        Reserve a relay slot for `username`.
+
+        Returns (slot, None) on success; the caller must release_stream(username, slot).
+        Otherwise (None, (status, retry_after)): 429 when the user is at their
+        cap, 503 when this worker's relay pool is full.
+        """
+        with self._lock:
+            if max_relays and self._relays >= max_relays:
+                return None, (503, 5)
+            if self.slots is None and max_streams and self._streams[username] >= max_streams:
+                return None, (429, 10)
+            self._relays += 1
+            self._streams[username] += 1
+
+        slot = None
+        if self.slots is not None:
+            slot = self.slots.acquire(username, max_streams)
+            if slot is None:
+                self.release_stream(username)
+                return None, (429, 10)
+        return slot, None
+
+    def release_stream(self, username, slot=None):
+        if slot is not None:
+            self.slots.release(slot)
+        with self._lock:
+            self._relays = max(0, self._relays - 1)
+            self._streams[username] -= 1
+            if self._streams[username] <= 0:
+                del self._streams[username]
+
+    def active_streams(self, username=None):
+        """A user's streams across all workers (when slots are shared), or this worker's relay count"""
+        if username is not None and self.slots is not None:
+            return self.slots.count(username)
+        with self._lock:
+            return self._relays if username is None else self._streams.get(username, 0)
+
+
+admission = AdmissionController()
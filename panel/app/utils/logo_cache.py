@@ -0,0 +1,175 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Raster image signatures -> mimetype. Only these are cached and served:
+# logos come from provider playlists, and anything scriptable (SVG, HTML)
+# served from the panel's origin would run alongside the admin session.
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+
+
+@lru_cache(maxsize=65536)
+def logo_token(url, secret):
+    """
+    Opaque /logo/<id> id for a logo URL: the URL itself plus an HMAC, so
+    any worker can resolve it without a shared registry while the endpoint
+    still only fetches URLs we handed out.
+    """
+    encoded = base64.urlsafe_b64encode(url.encode('utf-8')).decode().rstrip('=')
+    signature = hmac.new(secret.encode(), url.encode('utf-8'), hashlib.sha256).hexdigest()[:20]
+    return f"{encoded}.{signature}"
+
+
+def resolve_token(token, secret):
+    """Logo URL for a token, or None if it is malformed or not signed by us"""
+    encoded, _, signature = token.partition('.')
+    try:
+        url = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    expected = hmac.new(secret.encode(), url.encode('utf-8'), hashlib.sha256).hexdigest()[:20]
+    return url if hmac.compare_digest(signature, expected) else None
+
+
+def sniff_mimetype(data):
+    """Mimetype of raster image bytes (png/jpeg/gif/webp/ico), or None for anything else"""
+    for signature, mimetype in _SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def sniff_file(path):
+    with open(path, 'rb') as f:
+        return sniff_mimetype(f.read(16))
+
+
+class LogoCache:
+    """
+    Size-capped on-disk LRU cache of channel logos.
+
+    Each logo is one file named after the hash of its URL; a file's mtime is
+    its last use, and the least recently used files are deleted once the
+    total size passes max_bytes. URLs that fail are remembered with an empty
+    '.miss' marker for negative_ttl seconds so dead CDNs are not retried on
+    every page load.
+    """
+
+    def __init__(self, directory, max_bytes, negative_ttl=3600, max_logo_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.max_logo_bytes = max_logo_bytes
+        self._lock = threading.Lock()
+        self._size = None  # computed on first store
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        Returns (path, None) for a cached logo, (None, 'miss') for a recent
+        failure, or (None, None) when the URL has to be fetched.
+        """
+        path = self._path(url)
+        try:
+            os.utime(path)  # mark as recently used
+            return path, None
+        except FileNotFoundError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(path + '.miss') < self.negative_ttl:
+                return None, 'miss'
+        except FileNotFoundError:
+            pass
+        return None, None
+
+    def fetch(self, url, timeout=5):
+        """Download `url` into the cache. Returns the cached path, or None (and records a miss)."""
+        path = self._path(url)
+        try:
+            resp = requests.get(url, timeout=timeout, stream=True,
+                                headers={'User-Agent': 'NexusLB/1.0', 'Accept': 'image/*'})
+            with resp:
+                content_type = resp.headers.get('content-type', '')
+                if resp.status_code != 200 or not content_type.startswith('image/'):
+                    raise ValueError(f"{resp.status_code} {content_type or 'no content-type'}")
+                data = resp.raw.read(self.max_logo_bytes + 1, decode_content=True)
+                if len(data) > self.max_logo_bytes:
+                    raise ValueError('logo too large')
+                # Trust the bytes, not the provider's content-type
+                if sniff_mimetype(data) is None:
+                    raise ValueError(f"not a raster image ({content_type})")
+        except (requests.RequestException, ValueError) as e:
+            logger.info(f"  ⚠ Logo fetch failed ({str(e)[:60]}): {url[:80]}")
+            self._mark_miss(path)
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._account(len(data), keep=path)
+        return path
+
+    def _mark_miss(self, path):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + '.miss', 'w'):
+            pass
+
+    def _account(self, added, keep=None):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                                 if entry.is_file() and '.' not in entry.name)
+            else:
+                self._size += added
+            if self._size > self.max_bytes:
+                self._evict(keep)
+
+    def _evict(self, keep=None):
+        """Delete least recently used logos (except `keep`) until the cache is at 90% of max_bytes"""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if '.' not in entry.name:
+                entries.append(entry)
+            elif entry.name.endswith('.miss') and now - entry.stat().st_mtime > self.negative_ttl:
+                os.remove(entry.path)  # expired negative entry
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for entry in entries:
+            if size <= target:
+                break
+            if entry.path == keep:
+                continue
+            try:
+                size -= entry.stat().st_size
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        self._size = size
+        logger.info(f"✓ Logo cache: evicted {removed} logos ({size / 1024 / 1024:.1f} MB kept)")
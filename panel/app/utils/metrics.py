@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import deque
+
+import psutil
+
+from .health import source_health
+from .limits import admission
+
+
+class MetricsSampler:
+    """
+    Fixed-size ring buffer of host and traffic samples, filled by a
+    background job so dashboard requests never touch psutil themselves.
+
+    Each sample has a sequence number; readers ask for everything after the
+    last one they saw (see since/wait_since). Relay counts and upstream
+    health are this worker's view, as they are kept in-process.
+    """
+
+    def __init__(self, history=720):
+        self._samples = deque(maxlen=history)
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._last_net = None  # (monotonic time, bytes_recv, bytes_sent)
+        self.boot_time = psutil.boot_time()
+
+    def resize(self, history):
+        with self._cond:
+            self._samples = deque(self._samples, maxlen=history)
+
+    def sample(self):
+        """Take one sample (scheduler job)"""
+        now = time.monotonic()
+        net = psutil.net_io_counters()
+        rx_rate = tx_rate = 0.0
+        if self._last_net is not None:
+            elapsed = now - self._last_net[0]
+            if elapsed > 0:
+                # Counters can go backwards if an interface disappears; clamp at zero
+                rx_rate = max(0, net.bytes_recv - self._last_net[1]) / elapsed
+                tx_rate = max(0, net.bytes_sent - self._last_net[2]) / elapsed
+        self._last_net = (now, net.bytes_recv, net.bytes_sent)
+
+        sample = {
+            'ts': time.time(),
+            'cpu': psutil.cpu_percent(interval=None),  # since the previous sample
+            'memory': psutil.virtual_memory().percent,
+            'disk': psutil.disk_usage('/').percent,
+            'net_rx': round(rx_rate),
+            'net_tx': round(tx_rate),
+            'relays': admission.active_streams(),
+            'upstreams': {host: round(stats['score'], 2)
+                          for host, stats in source_health.snapshot().items()},
+        }
+        with self._cond:
+            self._seq += 1
+            sample['seq'] = self._seq
+            self._samples.append(sample)
+            self._cond.notify_all()
+        return sample
+
+    def latest(self):
+        with self._cond:
+            return self._samples[-1] if self._samples else None
+
+    def since(self, seq):
+        """Samples newer than `seq`, oldest first (everything buffered if seq is from before a restart)"""
+        with self._cond:
+            if seq > self._seq:
+                seq = 0
+            return [sample for sample in self._samples if sample['seq'] > seq]
+
+    def wait_since(self, seq, timeout):
+        """Like since(), but waits up to `timeout` seconds for a new sample if there is none yet"""
+        with self._cond:
+            if seq > self._seq:
+                seq = 0  # from before a restart: everything buffered is new
+            if seq == self._seq:
+                self._cond.wait(timeout)
+        return self.since(seq)
+
+
+metrics = MetricsSampler()
@@ -0,0 +1,29 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+def add_missing_columns(db):
+    """
+    Add columns that exist on the models but not in the database.
+
+    db.create_all() only creates missing tables, so a panel.db created by an
+    older version would never get new model columns. New columns are always
+    nullable, so a plain ALTER TABLE ... ADD COLUMN is enough (no migration tool).
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'))
+                logger.info(f"✓ Added column {table.name}.{column.name}")
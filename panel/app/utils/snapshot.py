@@ -0,0 +1,115 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# File layout:
+#   MAGIC (8 bytes) | header length (uint32, little endian) | header JSON | blobs...
+# The header maps blob names to (offset, length) within the file, so a reader
+# only parses the small header and slices blobs out of the mapping on demand.
+MAGIC = b'NXLBSNP1'
+_HEADER_LEN = struct.Struct('<I')
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot file"""
+
+    def __init__(self, path, mapping, header):
+        self.path = path
+        self._mapping = mapping
+        self.header = header
+
+    @classmethod
+    def open(cls, path):
+        """Map `path` and parse its header. Returns None if missing or unreadable."""
+        try:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        prefix = len(MAGIC) + _HEADER_LEN.size
+        if len(mapping) < prefix or mapping[:len(MAGIC)] != MAGIC:
+            logger.warning(f"⚠ Ignoring snapshot {path}: bad magic")
+            mapping.close()
+            return None
+        try:
+            (header_len,) = _HEADER_LEN.unpack(mapping[len(MAGIC):prefix])
+            header = json.loads(mapping[prefix:prefix + header_len].decode('utf-8'))
+        except (struct.error, ValueError) as e:
+            logger.warning(f"⚠ Ignoring snapshot {path}: {e}")
+            mapping.close()
+            return None
+        return cls(path, mapping, header)
+
+    def blob(self, name):
+        """Decoded text of a named blob, or None (also if it does not decode)"""
+        data = self.raw(name)
+        if data is None:
+            return None
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            logger.warning(f"⚠ Ignoring snapshot blob {name}: {e}")
+            return None
+
+    def raw(self, name):
+        """Bytes of a named blob, or None"""
+        location = self.header.get('blobs', {}).get(name)
+        if location is None:
+            return None
+        offset, length = location
+        return self._mapping[offset:offset + length]
+
+
+def write_snapshot(path, header, blobs):
+    """
+    Atomically write a snapshot.
+
+    Args:
+        header: JSON-serializable dict; a 'blobs' key is added with the layout
+        blobs: {name: str or bytes}
+    """
+    encoded = {name: data.encode('utf-8') if isinstance(data, str) else data
+               for name, data in blobs.items()}
+
+    # Offsets depend on the header length, which depends on the offsets;
+    # iterate until the header size is stable (converges in one or two passes)
+    header = dict(header)
+    header_bytes = b''
+    while True:
+        offset = len(MAGIC) + _HEADER_LEN.size + len(header_bytes)
+        layout = {}
+        for name, data in encoded.items():
+            layout[name] = [offset, len(data)]
+            offset += len(data)
+        header['blobs'] = layout
+        candidate = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        if len(candidate) == len(header_bytes):
+            header_bytes = candidate
+            break
+        header_bytes = candidate
+
+    # Each writer gets its own temp file, so workers saving at the same time
+    # cannot interleave; the last complete file to be renamed in wins
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for data in encoded.values():
+                f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
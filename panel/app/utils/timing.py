@@ -0,0 +1,201 @@
+import _thread
+import itertools
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, current_app, request
+
+from ..models import Settings
+
+logger = logging.getLogger(__name__)
+
+# Requests seen by this worker, used for 1-in-N profiler sampling
+_request_counter = itertools.count(1)
+
+# Settings override for the sample rate, re-read at most every SETTINGS_TTL seconds
+SETTINGS_TTL = 30
+_sample_rate_cache = {'value': None, 'timestamp': 0.0}
+
+
+class PhaseTimer:
+    """Collects named phase durations for the Server-Timing header"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, (time.perf_counter() - start) * 1000))
+
+    def header_value(self):
+        """Returns e.g. 'auth;dur=212.4, fetch;dur=1840.0, total;dur=2061.9'"""
+        total = (time.perf_counter() - self.started) * 1000
+        parts = [f"{name};dur={ms:.1f}" for name, ms in self.phases]
+        parts.append(f"total;dur={total:.1f}")
+        return ', '.join(parts)
+
+
+@contextmanager
+def phase(name):
+    """Time a block as a named phase of the current request (no-op outside one)"""
+    timer = g.get('phase_timer')
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+def _native_thread_api():
+    """
+    (start_new_thread, get_ident, sleep, allocate_lock) that use real OS
+    threads even when gevent has monkey-patched the stdlib. The sampler must
+    run on its own OS thread or it would never preempt the request it samples.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            return (monkey.get_original('_thread', 'start_new_thread'),
+                    monkey.get_original('_thread', 'get_ident'),
+                    monkey.get_original('time', 'sleep'),
+                    monkey.get_original('_thread', 'allocate_lock'))
+    except ImportError:
+        pass
+    return _thread.start_new_thread, _thread.get_ident, time.sleep, _thread.allocate_lock
+
+
+def _current_greenlet():
+    """The running greenlet when serving under gevent, else None"""
+    try:
+        from gevent import monkey, getcurrent
+    except ImportError:
+        return None
+    return getcurrent() if monkey.is_module_patched('threading') else None
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the calling request at a fixed interval and
+    aggregates the samples as collapsed stacks ("outer;inner;leaf count"),
+    the input format of flamegraph.pl and speedscope.
+
+    Under gevent the request is a greenlet: while it is switched out its
+    suspended frame is sampled (showing where it waits on I/O), while it runs
+    the OS thread's frame is.
+    """
+
+    def __init__(self, interval=0.005):
+        self._start_new_thread, get_ident, self._sleep, allocate_lock = _native_thread_api()
+        self.thread_id = get_ident()
+        self.greenlet = _current_greenlet()
+        self.interval = interval
+        self.samples = Counter()
+        self._lock = allocate_lock()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._start_new_thread(self._run, ())
+
+    def stop(self):
+        self._running = False
+
+    def _current_frame(self):
+        if self.greenlet is not None and self.greenlet.gr_frame is not None:
+            return self.greenlet.gr_frame
+        return sys._current_frames().get(self.thread_id)
+
+    def _run(self):
+        while True:
+            self._sleep(self.interval)
+            if not self._running:
+                return
+            frame = self._current_frame()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            with self._lock:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with self._lock:
+            samples = self.samples.most_common()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in samples:
+                f.write(f"{stack} {count}\n")
+
+
+def get_sample_rate():
+    """
+    Profile 1 in N requests. N comes from the 'profile_sample_rate' Settings
+    row when set (so it can be changed without redeploying), otherwise from
+    PROFILE_SAMPLE_RATE. 0 disables profiling.
+    """
+    now = time.monotonic()
+    if now - _sample_rate_cache['timestamp'] > SETTINGS_TTL:
+        value = current_app.config.get('PROFILE_SAMPLE_RATE', 0)
+        try:
+            row = Settings.query.filter_by(key='profile_sample_rate').first()
+            if row and row.value not in (None, ''):
+                value = int(row.value)
+        except Exception as e:
+            logger.warning(f"⚠ Could not read profile_sample_rate: {e}")
+        _sample_rate_cache['value'] = value
+        _sample_rate_cache['timestamp'] = now
+    return _sample_rate_cache['value'] or 0
+
+
+def reset_sample_rate_cache():
+    _sample_rate_cache['timestamp'] = 0.0
+
+
+def start_request_timing():
+    """before_request hook: start the phase timer and maybe the profiler"""
+    g.phase_timer = PhaseTimer()
+    rate = get_sample_rate()
+    if rate > 0 and next(_request_counter) % rate == 0:
+        g.profiler = SamplingProfiler()
+        g.profiler.start()
+
+
+def finish_request_timing(response):
+    """after_request hook: emit Server-Timing and dump any profile taken"""
+    timer = g.get('phase_timer')
+    if timer is not None:
+        response.headers['Server-Timing'] = timer.header_value()
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        path = os.path.join(
+            current_app.config['PROFILE_DIR'],
+            f"{request.endpoint}-{int(time.time() * 1000)}.folded"
+        )
+        if response.is_streamed:
+            # Relays and streamed playlists do their work while the body is sent
+            response.call_on_close(lambda: _finish_profile(profiler, path))
+        else:
+            _finish_profile(profiler, path)
+    return response
+
+
+def _finish_profile(profiler, path):
+    profiler.stop()
+    try:
+        profiler.dump(path)
+        logger.info(f"✓ Profile written to {path} ({sum(profiler.samples.values())} samples)")
+    except OSError as e:
+        logger.warning(f"⚠ Could not write profile: {e}")
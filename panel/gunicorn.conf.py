@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+# Gunicorn settings, overridable from the container environment.
+#
+# The default is the gevent worker: every request runs in a greenlet and
+# socket I/O (requests, SQLite aside) yields to the event loop, so a slow
+# upstream fetch or a long /stream/ relay no longer blocks other clients and
+# an idle relay costs one greenlet rather than one worker.
+# Set GUNICORN_WORKER_CLASS=sync to get the old one-request-per-worker behaviour.
+# Under sync workers a dashboard metrics stream (SSE) would hold a whole
+# worker, so it then sends one batch per connection and the browser polls.
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+# One worker per core: each gevent worker is a single OS thread, so CPU-bound
+# work (bcrypt, playlist builds) only uses more cores with more workers
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+
+# Max concurrent greenlets (connections) per gevent worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+
+# Relays are long-lived; the async worker heartbeats independently of requests
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))